@@ -6,11 +6,20 @@
 # using the same units (usually kB)
 
 import argparse
-import re
+import os
 import sys
 
 # Constants
-meminfo_re = re.compile("^\s*([a-zA-Z0-9_\(\)]+):\s+([0-9]+)\s*?([a-zA-Z]*?)\s*?$")
+MEMINFO_FIELDS = {
+    'memtotal': b'\nMemTotal:',
+    'memavailable': b'\nMemAvailable:',
+}
+# Only needed on kernels older than 3.14, which don't provide MemAvailable
+MEMINFO_FALLBACK_FIELDS = {
+    'buffers': b'\nBuffers:',
+    'cached': b'\nCached:',
+}
+MEMINFO_READ_SIZE = 8192
 NAGIOS_OK = 0
 NAGIOS_WARNING = 1
 NAGIOS_CRITICAL = 2
@@ -60,17 +69,53 @@ def read_meminfo(args):
     Parse the /proc/meminfo file
     """
 
+    # Read straight from the fd; the file is tiny and we work on the raw
+    # bytes, so the buffered/text layers of open() would be pure overhead.
+    # Prefix a newline so every field, including the first, can be found
+    # by searching for "\n<Name>:" (which also keeps "Cached:" from
+    # matching "SwapCached:")
+    chunks = [b'\n']
+    fd = os.open("/proc/meminfo", os.O_RDONLY)
+    try:
+        while True:
+            chunk = os.read(fd, MEMINFO_READ_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+
+    buf = b''.join(chunks)
+
+    meminfo = parse_meminfo_fields(buf, MEMINFO_FIELDS)
+
+    # Pre-xenial kernels have no MemAvailable, so go back for what we need
+    # to approximate it
+    if 'memavailable' not in meminfo:
+        meminfo.update(parse_meminfo_fields(buf, MEMINFO_FALLBACK_FIELDS))
+
+    return meminfo
+
+def parse_meminfo_fields(buf, fields):
+    """
+    Pull the requested fields out of the raw contents of /proc/meminfo
+    """
+
     meminfo = {}
 
-    with open("/proc/meminfo", "r") as meminfo_fh:
-        for line in meminfo_fh.readlines():
-            line = line.strip()
-            matches = meminfo_re.search(line)
-            if matches:
-                meminfo[matches.group(1).lower()] = {
-                    'value': int(matches.group(2)),
-                    'unit': matches.group(3),
-                }
+    for name, key in fields.items():
+        pos = buf.find(key)
+        if pos == -1:
+            continue
+
+        pos += len(key)
+        end = buf.find(b'\n', pos)
+        parts = buf[pos:end if end != -1 else len(buf)].split()
+
+        meminfo[name] = {
+            'value': int(parts[0]),
+            'unit': parts[1].decode() if len(parts) > 1 else '',
+        }
 
     return meminfo
 
@@ -100,7 +145,12 @@ def output_response(args, meminfo):
         output = "OK - {}".format(rendered)
 
     print(output)
-    sys.exit(status)
+
+    # Nothing needs cleaning up at this point, so skip the interpreter's
+    # shutdown work.  os._exit doesn't flush stdio buffers or run atexit
+    # handlers, hence the explicit flush.
+    sys.stdout.flush()
+    os._exit(status)
 
 def normalize_mem_info(meminfo):
     """
@@ -3,14 +3,14 @@
 # This script can be used with nagios to determine the size of a directory
 
 import argparse
+import errno
 import os
 import os.path
-import re
 import sys
+import time
 
 
 # Constants
-value_re = re.compile("^([0-9]+)([kKmMgG]?)$")
 NAGIOS_OK = 0
 NAGIOS_WARNING = 1
 NAGIOS_CRITICAL = 2
@@ -20,10 +20,41 @@ KILOBYTE = 1024
 MEGABYTE = 1024 ** 2
 GIGABYTE = 1024 ** 3
 
+# Indexed by power of 1024
+UNIT_NAMES = ('bytes', 'KB', 'MB', 'GB')
+
+SUFFIX_MULTIPLIERS = {
+    '': 1,
+    'k': KILOBYTE, 'K': KILOBYTE,
+    'm': MEGABYTE, 'M': MEGABYTE,
+    'g': GIGABYTE, 'G': GIGABYTE,
+}
+
+DIR_OPEN_FLAGS = os.O_RDONLY | os.O_DIRECTORY
+# Errors that mean a directory can't be listed (or is gone, or was swapped
+# for a symlink mid-walk), which like os.walk we quietly skip.  Anything
+# else, such as running out of fds, has to fail the check instead.
+SKIPPED_DIR_ERRORS = {errno.EACCES, errno.ENOENT, errno.ENOTDIR, errno.ELOOP}
+MAX_WALK_THREADS = 8
+# Spreading the walk over threads costs a good few ms in imports alone, so
+# only do it when the top level has more subdirectories than this
+MIN_PARALLEL_SUBDIRS = 2
+
+CACHE_DIR = '/var/tmp'
+# Directories modified this close to the mtime scan may change again
+# within the same timestamp tick, so a result based on them isn't cached
+CACHE_RACY_WINDOW_NS = 2 * 10 ** 9
+
 
 def main():
     args = parse_cli_args()
-    dir_size = find_dir_size(args)
+
+    try:
+        dir_size = find_dir_size(args)
+    except OSError as err:
+        print("UNKNOWN - Unable to size {}: {}".format(args.dir, err))
+        sys.exit(NAGIOS_UNKNOWN)
+
     output_response(args, dir_size)
 
 
@@ -53,6 +84,17 @@ def parse_cli_args():
         help="Indicates the search should not cross filesystem devices"
     )
 
+    # Reuse the last result if the tree hasn't changed
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        default=False,
+        help="Remember the size between runs and reuse it if no directory in " \
+            "the tree has been modified since.  Files that change size in " \
+            "place (ie being appended to) don't touch their directory, so " \
+            "that sort of change won't be picked up"
+    )
+
     # Warn range
     parser.add_argument(
         '--warn', '-w',
@@ -128,26 +170,17 @@ def normalize_value(value):
     Converts a value with a potential suffix of k/m/g to a full numeric value
     """
 
-    value = str(value)
+    value = str(value).strip()
+    number, suffix = value[:-1], value[-1:]
 
-    match = value_re.fullmatch(value)
+    if suffix not in SUFFIX_MULTIPLIERS:
+        number, suffix = value, ''
 
-    if not match:
+    # int() alone would also accept signs, underscores and non-ascii digits
+    if not (number.isascii() and number.isdigit()):
         raise ValueError('Does not match regex')
 
-    if not match.group(2):
-        normalized = int(match.group(1))
-    
-    elif match.group(2) in 'kK':
-        normalized = int(match.group(1)) * KILOBYTE
-    
-    elif match.group(2) in 'mM':
-        normalized = int(match.group(1)) * MEGABYTE
-    
-    elif match.group(2) in 'gG':
-        normalized = int(match.group(1)) * GIGABYTE
-
-    return normalized
+    return int(number) * SUFFIX_MULTIPLIERS[suffix]
 
 
 def verify_range_validity(args):
@@ -177,36 +210,361 @@ def verify_range_validity(args):
 
 def find_dir_size(args):
 
+    try:
+        dir_fd = os.open(args.dir, DIR_OPEN_FLAGS)
+    except OSError as err:
+        if err.errno not in SKIPPED_DIR_ERRORS:
+            raise
+        return 0
+
+    try:
+        orig_dev = os.fstat(dir_fd).st_dev if args.xdev else None
+
+        if args.cache:
+            # Directory mtimes are gathered before the walk, so anything
+            # that changes while we're walking invalidates the next run
+            cache_file = get_cache_file(args)
+            scan_time_ns = time.time_ns()
+            mtimes = _dir_mtimes(dir_fd, args.dir, orig_dev, args.xdev)
+            cached = read_cache(cache_file)
+
+            if cached is not None and cached['mtimes'] == mtimes:
+                return cached['total_bytes']
+
+        total_bytes = _walk(
+            dir_fd, args.dir, '.', orig_dev, args.xdev, parallel=True
+        )
+
+        # Like git's racily clean index entries: if a directory was touched
+        # within a timestamp tick of the scan, a later change could leave
+        # its mtime the same, and the cache would never notice
+        if args.cache:
+            newest_ns = max(mtimes.values(), default=0)
+            if newest_ns < scan_time_ns - CACHE_RACY_WINDOW_NS:
+                write_cache(cache_file, total_bytes, mtimes)
+
+        return total_bytes
+    finally:
+        os.close(dir_fd)
+
+
+def _walk(parent_fd, parent_path, name, orig_dev, xdev, parallel=False):
+    """
+    Total up the size of the non-symlink files in the tree rooted at the
+    directory name (relative to parent_fd, which is open on parent_path).
+
+    If parallel is set and the top of the tree has enough subdirectories,
+    they're sized in worker threads rather than walked here.
+    """
+
     total_bytes = 0
 
-    if args.xdev:
-        orig_dev = os.lstat(args.dir).st_dev
+    for path, dir_fd, files, subdirs in _iter_dirs(
+            parent_fd, parent_path, name, orig_dev, xdev):
 
-    for root, dirs, files in os.walk(args.dir, followlinks=False):
-        if args.xdev:
-            # If we've requested to stick to a single filesystem, filter out 
-            # those files that are "elsewhere"
-            if os.lstat(root).st_dev != orig_dev:
-                files = []
-            else:
-                files = [
-                    _ for _ in files
-                    if os.lstat(os.path.join(root, _)).st_dev == orig_dev
+        for entry in files:
+            total_bytes += entry.stat(follow_symlinks=False).st_size
+
+        # Only the top level is split up; each worker walks its own
+        # subtree inline
+        if parallel and len(subdirs) > MIN_PARALLEL_SUBDIRS:
+            total_bytes += _walk_parallel(
+                parent_fd, parent_path,
+                [os.path.join(path, sub) for sub in subdirs],
+                orig_dev, xdev
+            )
+            subdirs.clear()
+
+        parallel = False
+
+    return total_bytes
+
+
+def _walk_parallel(parent_fd, parent_path, names, orig_dev, xdev):
+    """
+    Size each of the named subtrees (relative to parent_fd, which is open
+    on parent_path) in a pool of worker threads.  The walk spends most of
+    its time blocked in stat calls, which release the GIL, so the subtrees'
+    metadata reads overlap.
+    """
+
+    # Imported here as it drags in logging, traceback and re, which runs
+    # that don't use the pool shouldn't pay for
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = min(MAX_WALK_THREADS, os.cpu_count() or 1)
+
+    # Each worker holds an fd per level of the path it's in, so a deep
+    # enough tree can run us out of fds; if so, fall back to walking the
+    # subtrees one at a time
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = [
+                executor.submit(
+                    _walk, parent_fd, parent_path, name, orig_dev, xdev
+                )
+                for name in names
+            ]
+
+            total_bytes = 0
+
+            try:
+                for future in pending:
+                    total_bytes += future.result()
+            except BaseException:
+                # Don't leave the rest of the subtrees queued up behind a
+                # failure
+                for future in pending:
+                    future.cancel()
+                raise
+
+            return total_bytes
+
+    except OSError as err:
+        if err.errno not in (errno.EMFILE, errno.ENFILE):
+            raise
+
+    total_bytes = 0
+
+    for name in names:
+        total_bytes += _walk(parent_fd, parent_path, name, orig_dev, xdev)
+
+    return total_bytes
+
+
+def _iter_dirs(parent_fd, parent_path, name, orig_dev, xdev):
+    """
+    Walk the tree rooted at the directory name (relative to parent_fd, which
+    is open on parent_path), yielding (path, dir_fd, files, subdirs) for each
+    directory in it, top down.  path is relative to parent_fd, files are the
+    DirEntry objects for everything that isn't a directory or symlink, and
+    subdirs can be pruned in place like with os.walk.  dir_fd is only open
+    until the next directory is requested.
+
+    Everything is resolved relative to an open directory, so the kernel
+    never has to walk a full path and a directory being renamed mid-scan
+    can't send us somewhere else.
+
+    Rather than recursing, directories still to be visited are kept on a
+    stack as (parent fd, name, path), and a parent's fd is closed as soon as
+    the last of its subdirectories has been opened.  That leaves us holding
+    an fd for each level of the current path that still has subdirectories
+    waiting.  If that runs us out of fds, those parents are let go and what
+    they had waiting is opened by its full path instead, as os.walk does.
+    """
+
+    stack = [(parent_fd, name, name)]
+
+    # Our open directory fds, mapped to how many of their subdirectories
+    # are still waiting on the stack
+    waiting = {}
+
+    try:
+        while stack:
+            parent_fd, name, path = stack[-1]
+            dir_fd = None
+
+            try:
+                dir_fd = _open_subdir(parent_fd, name)
+                if dir_fd is not None:
+                    waiting[dir_fd] = 0
+                    files, subdirs = _scan_dir(dir_fd, orig_dev, xdev)
+
+            except OSError as err:
+                if err.errno not in (errno.EMFILE, errno.ENFILE):
+                    raise
+
+                if dir_fd is not None:
+                    del waiting[dir_fd]
+                    os.close(dir_fd)
+
+                # If we aren't holding any parents there's nothing to free
+                if not waiting:
+                    raise
+
+                stack = [
+                    (None, os.path.join(parent_path, item_path), item_path)
+                    if item_fd in waiting else (item_fd, item_name, item_path)
+                    for item_fd, item_name, item_path in stack
                 ]
 
-        # Get the size of all files in the directory
-        dir_bytes = sum(
-            os.path.getsize(os.path.join(root, _))
-            for _ in files
-            if not os.path.islink(os.path.join(root, _))
+                for fd in waiting:
+                    os.close(fd)
+                waiting.clear()
+                continue
+
+            stack.pop()
+
+            # The caller's fd isn't in waiting, so is never closed here
+            if parent_fd in waiting:
+                waiting[parent_fd] -= 1
+                if not waiting[parent_fd]:
+                    del waiting[parent_fd]
+                    os.close(parent_fd)
+
+            if dir_fd is None:
+                continue
+
+            yield path, dir_fd, files, subdirs
+
+            if subdirs:
+                waiting[dir_fd] = len(subdirs)
+                stack.extend(
+                    (dir_fd, sub, os.path.join(path, sub))
+                    for sub in reversed(subdirs)
+                )
+            else:
+                del waiting[dir_fd]
+                os.close(dir_fd)
+    finally:
+        for fd in waiting:
+            os.close(fd)
+
+
+def _open_subdir(parent_fd, name):
+    """
+    Open the named subdirectory of parent_fd (or the path name, if
+    parent_fd is None), or return None if it can't be listed
+    """
+
+    try:
+        return os.open(name, DIR_OPEN_FLAGS | os.O_NOFOLLOW, dir_fd=parent_fd)
+    except OSError as err:
+        if err.errno not in SKIPPED_DIR_ERRORS:
+            raise
+        return None
+
+
+def _scan_dir(dir_fd, orig_dev, xdev):
+    """
+    Split the contents of the directory open as dir_fd into the entries for
+    its files and the names of the subdirectories to descend into.  The
+    listing is finished (and its fd closed) before we go any deeper.
+    """
+
+    files = []
+    subdirs = []
+
+    for entry in _list_dir(dir_fd):
+        if entry.is_dir(follow_symlinks=False):
+            # If we've requested to stick to a single filesystem, skip
+            # directories that are mountpoints for somewhere else.
+            # Files can't cross devices without a directory doing so
+            # first, so they don't need checking individually.
+            if xdev and entry.stat(follow_symlinks=False).st_dev != orig_dev:
+                continue
+
+            subdirs.append(entry.name)
+
+        elif not entry.is_symlink():
+            files.append(entry)
+
+    return files, subdirs
+
+
+def _list_dir(dir_fd):
+    """
+    Yield the entries of the directory open as dir_fd.  Like os.walk, a
+    directory that can't be read is treated as empty (or as ending where
+    the error happened).
+    """
+
+    try:
+        with os.scandir(dir_fd) as it:
+            yield from it
+    except OSError as err:
+        if err.errno not in SKIPPED_DIR_ERRORS:
+            raise
+
+
+def _dir_mtimes(dir_fd, dir_path, orig_dev, xdev):
+    """
+    Map the relative path of every directory in the tree to its mtime.
+
+    Only directories are stat'ed; any file being added, removed or renamed
+    changes the mtime of the directory containing it.
+    """
+
+    return {
+        path: os.fstat(sub_fd).st_mtime_ns
+        for path, sub_fd, _, _ in _iter_dirs(
+            dir_fd, dir_path, '.', orig_dev, xdev
         )
-        total_bytes += dir_bytes
-        #print(root, "consumes", end=" ")
-        #print(dir_bytes, end=" ")
-        #print("bytes in", len(files), "non-directory files")
+    }
 
-    #print("Total bytes: ", str(total_bytes))
-    return total_bytes
+
+def get_cache_file(args):
+    """
+    Work out where the cached result for this directory/xdev combo lives
+    """
+
+    # The cache helpers' imports are deferred so runs without --cache
+    # don't pay for them
+    import hashlib
+
+    key = "{}\0{}".format(os.path.abspath(args.dir), args.xdev)
+    digest = hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    return os.path.join(CACHE_DIR, "check_dir_size.cache.{}".format(digest))
+
+
+def read_cache(cache_file):
+    """
+    Load a previously cached result, or None if there isn't a usable one
+    """
+
+    import json
+
+    try:
+        fd = os.open(cache_file, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+
+    with os.fdopen(fd, 'r') as cache_fh:
+        # The cache lives in a shared directory, so don't trust anything
+        # that somebody else could have written
+        if os.fstat(fd).st_uid != os.geteuid():
+            return None
+
+        try:
+            cached = json.load(cache_fh)
+        except ValueError:
+            return None
+
+    if not isinstance(cached, dict) or \
+            not isinstance(cached.get('total_bytes'), int) or \
+            not isinstance(cached.get('mtimes'), dict):
+        return None
+
+    return cached
+
+
+def write_cache(cache_file, total_bytes, mtimes):
+    """
+    Save the result of a walk for the next run.  Failing to do so isn't
+    fatal, it just means the next run has to walk the tree again.
+    """
+
+    import json
+    import tempfile
+
+    try:
+        fd, tmp_name = tempfile.mkstemp(
+            dir=os.path.dirname(cache_file),
+            prefix=os.path.basename(cache_file) + '.'
+        )
+    except OSError:
+        return
+
+    try:
+        with os.fdopen(fd, 'w') as cache_fh:
+            json.dump({'total_bytes': total_bytes, 'mtimes': mtimes}, cache_fh)
+        os.replace(tmp_name, cache_file)
+    except OSError:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
 
 
 def output_response(args, dir_size):
@@ -229,7 +587,12 @@ def output_response(args, dir_size):
         message = "OK - {}".format(message)
 
     print(message)
-    sys.exit(status)
+
+    # Nothing needs cleaning up at this point, so skip the interpreter's
+    # shutdown work.  os._exit doesn't flush stdio buffers or run atexit
+    # handlers, hence the explicit flush.
+    sys.stdout.flush()
+    os._exit(status)
 
 
 def prettify_number(number):
@@ -237,15 +600,17 @@ def prettify_number(number):
     Take an integer and convert it to a units based string
     """
 
-    if number > GIGABYTE:
-        return "{:.3f}GB".format(number/float(GIGABYTE))
-    elif number > MEGABYTE:
-        return "{:.3f}MB".format(number/float(MEGABYTE))
-    elif number > KILOBYTE:
-        return "{:.3f}KB".format(number/float(KILOBYTE))
-    else:
+    # number > 1024 ** power exactly when number - 1 needs more than
+    # 10 * power bits, so the power of 1024 comes from (number - 1)'s
+    # bit_length, clamped to the range of UNIT_NAMES
+    power = max((number - 1).bit_length() - 1, 0) // 10
+    power = min(power, len(UNIT_NAMES) - 1)
+
+    if not power:
         return "{} bytes".format(str(number))
 
+    return "{:.3f}{}".format(number / (1 << (10 * power)), UNIT_NAMES[power])
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file